@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import concurrent.futures
 import datetime
-from filelock import FileLock
+from filelock import FileLock, Timeout
 import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 
 logging.basicConfig(
@@ -21,12 +25,49 @@ logging.basicConfig(
 
 logger = logging.getLogger('')
 
-PATTERN_RECORDINGS = r'(\d+_\d+)_([A-Z]+)\.(.+)'
-PATTERN_WORKFILES = r'(\d+_\d+)-(\d+_\d+)_([A-Z]+)\.(.+)'
-PATTERN_OUTPUTFILES = r'(\d+_\d+)-(\d+_\d+)_([A-Z]+)\.(.+)'
+# The timestamp components are captured directly so the datetime can be
+# built from the match without a second parse of the string.
+PATTERN_RECORDINGS = r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})_([A-Z]+)\.(.+)'
+# The lookahead keeps cleanup away from .lock files, which are live
+# synchronization state and must never be deleted by retention.
+PATTERN_WORKFILES = r'(?!.+\.lock$)(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})-(\d+_\d+)_([A-Z]+)\.(.+)'
+PATTERN_OUTPUTFILES = r'(?!.+\.lock$)(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})-(\d+_\d+)_([A-Z]+)\.(.+)'
+
+_RE_RECORDINGS = re.compile(PATTERN_RECORDINGS)
+_RE_WORKFILES = re.compile(PATTERN_WORKFILES)
+_RE_OUTPUTFILES = re.compile(PATTERN_OUTPUTFILES)
+
+def _dt_from_match(m):
+    return datetime.datetime(int(m[1]), int(m[2]), int(m[3]), int(m[4]), int(m[5]), int(m[6]))
+
+class VideoItem:
+    # One instance per recording file; __slots__ keeps it to a fraction of
+    # an equivalent dict for archives with tens of thousands of files.
+    __slots__ = ('dt', 'type', 'ext', 'path')
+
+    def __init__(self, dt, type_, ext, path):
+        self.dt = dt
+        self.type = type_
+        self.ext = ext
+        self.path = path
 
 VALID_LOGGING_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
 
+def _clamp_ffmpeg_threads(n):
+    return min(64, max(1, n))
+
+def _env_ffmpeg_threads():
+    # The shipped compose file sets env vars to empty strings by default,
+    # so an unset or unparsable value must fall back to None, not crash.
+    value = os.environ.get('BVC_FFMPEG_THREADS') or None
+    if value is None:
+        return None
+    try:
+        return _clamp_ffmpeg_threads(int(value))
+    except ValueError:
+        logger.warning('BVC_FFMPEG_THREADS=%s is not an integer, ignored', value)
+        return None
+
 DEFAULT_VALUES = {
     'logging_level': VALID_LOGGING_LEVELS[2],
     'sourcedir': os.getcwd(),
@@ -34,9 +75,30 @@ DEFAULT_VALUES = {
     'outputdir': os.getcwd(),
     'consecutive_threshold': 64,
     'concat_threshold': 2,
-    'retention': 14
+    'retention': 14,
+    'probe_workers': max(1, (os.cpu_count() or 2) // 2),
+    'chunk_workers': max(1, (os.cpu_count() or 2) // 2),
+    'ffmpeg_threads_per_invocation': _env_ffmpeg_threads()
 }
 
+# Resolved ffmpeg binary path, cached so every subprocess spawn skips the
+# PATH search. Worker processes fill it once on first use.
+_FFMPEG_BIN = None
+
+def _ffmpeg_bin():
+    global _FFMPEG_BIN
+    if _FFMPEG_BIN is None:
+        _FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+    return _FFMPEG_BIN
+
+# subprocess only swaps fork+exec for the much cheaper posix_spawn when it
+# does not have to close inherited descriptors itself; 3.13+ can do both
+# where libc provides posix_spawn_file_actions_addclosefrom_np.
+_SPAWN_KWARGS = {'close_fds': hasattr(os, 'POSIX_SPAWN_CLOSEFROM')}
+
+def _threads_per_invocation(n_workers):
+    return max(1, (os.cpu_count() or n_workers) // n_workers)
+
 def get_options():
 
     parser = argparse.ArgumentParser()
@@ -47,7 +109,13 @@ def get_options():
     parser.add_argument('--consecutive-threshold', default=DEFAULT_VALUES['consecutive_threshold'], type=int, help='If timestamp difference is less than the threshold, they are consecutive.')
     parser.add_argument('--concat-threshold', default=DEFAULT_VALUES['concat_threshold'], type=int, help='If the number of consecutive videos is less than the threshold, they are concatenated.')
     parser.add_argument('--retention', default=DEFAULT_VALUES['retention'], type=int, help='Retention days of concatenated recordings.')
+    parser.add_argument('--probe-workers', default=DEFAULT_VALUES['probe_workers'], type=int, help='Number of concurrent ffmpeg framemd5 probes.')
+    parser.add_argument('--chunk-workers', default=DEFAULT_VALUES['chunk_workers'], type=int, help='Number of chunks processed concurrently.')
+    parser.add_argument('--ffmpeg-threads-per-invocation', default=DEFAULT_VALUES['ffmpeg_threads_per_invocation'], type=int, help='Threads each ffmpeg process may use (1-64). Defaults to cores divided by probe workers.')
     parser.add_argument('--initial-impact', action='store_true', help='If set, a first impact event of a concatenated recordings is kept included.')
+    parser.add_argument('--fast-concat', action='store_true', help='If set, skip the framemd5 probes and let the concat filter drop duplicate frames. Halves input reads at the cost of frame-accurate trimming.')
+    parser.add_argument('--batch-probe', action='store_true', help='If set, probe all videos of a chunk in one ffmpeg invocation instead of one process per video.')
+    parser.add_argument('--keep-concat', action='store_true', help='If set, keep the concat list as a work file instead of only piping it to ffmpeg.')
     parser.add_argument('--no-output', action='store_true', help='If set, output files are not created.')
     parser.add_argument('--overwrite', action='store_true', help='If set, overwrite work and output files.')
 
@@ -69,80 +137,100 @@ def set_logging_level(options):
 
 def create_chunks(options):
     chunks = []
-    files = sorted(os.listdir(options.source_dir))
-    pattern = re.compile(PATTERN_RECORDINGS)
-    for f in files:
-        if not os.path.isfile(os.path.join(options.source_dir, f)):
-            continue
-        matches = pattern.match(f)
+    with os.scandir(options.source_dir) as it:
+        entries = sorted((e for e in it if e.is_file(follow_symlinks=False)), key=lambda e: e.name)
+    # cur_chunk and cur_impact_count shadow the open chunk so the hot loop
+    # avoids re-indexing chunks[-1] on every file.
+    cur_chunk = None
+    cur_impact_count = 0
+    for entry in entries:
+        f = entry.name
+        matches = _RE_RECORDINGS.match(f)
         if not matches:
             continue
-        datetime_obj = datetime.datetime.strptime(matches.group(1), '%Y%m%d_%H%M%S')
+        datetime_obj = _dt_from_match(matches)
+
 
+        obj = VideoItem(datetime_obj, matches.group(7), matches.group(8), entry.path)
 
-        obj = {'datetime': datetime_obj,
-               'type': matches.group(2),
-               'ext': matches.group(3),
-               'dir': options.source_dir,
-               'filename': f}
+        is_impact = obj.type[:1] == 'I'
 
-        if len(chunks) == 0:
-            chunks.append([])
-            chunks[-1].append(obj)
+        if cur_chunk is None:
+            cur_chunk = [obj]
+            chunks.append(cur_chunk)
+            cur_impact_count = int(is_impact)
             continue
 
-        if obj['datetime'] == chunks[-1][-1]['datetime']:
-            chunks[-1].append(obj)
+        last = cur_chunk[-1]
+        if obj.dt == last.dt:
+            cur_chunk.append(obj)
+            cur_impact_count += is_impact
             continue
 
-        duration = obj['datetime'] - chunks[-1][-1]['datetime']
+        duration = obj.dt - last.dt
         if int(duration.total_seconds()) <= options.consecutive_threshold:
             if options.initial_impact:
-                chunks[-1].append(obj)
+                cur_chunk.append(obj)
+                cur_impact_count += is_impact
             else:
-                impact_flag = 0
-                for item in chunks[-1]:
-                    if item['type'].startswith('I'):
-                        impact_flag += 1
-                if len(chunks[-1]) == impact_flag:
-                    if obj['type'].startswith('I'):
-                        chunks[-1].append(obj)
+                # cur_impact_count tracks impact recordings in the open chunk
+                # so the all-impact test is O(1) instead of a rescan per file.
+                if len(cur_chunk) == cur_impact_count:
+                    if is_impact:
+                        cur_chunk.append(obj)
+                        cur_impact_count += 1
                     else:
-                        chunks.append([])
-                        chunks[-1].append(obj)
+                        cur_chunk = [obj]
+                        chunks.append(cur_chunk)
+                        cur_impact_count = 0
                 else:
-                    chunks[-1].append(obj)
+                    cur_chunk.append(obj)
+                    cur_impact_count += is_impact
         else:
-            chunks.append([])
-            chunks[-1].append(obj)
+            cur_chunk = [obj]
+            chunks.append(cur_chunk)
+            cur_impact_count = int(is_impact)
     return chunks
 
 def process_chunks(options, chunks):
-    for chunk in chunks:
-        videos_f = []
-        videos_r = []
-        time_start = chunk[0]['datetime'].strftime('%Y%m%d_%H%M%S')
-        time_end = chunk[-1]['datetime'].strftime('%Y%m%d_%H%M%S')
-        logger.debug('{}-{}'.format(time_start, time_end))
-        if chunk[0]['datetime'].date() == chunk[-1]['datetime'].date():
-            title = '{} - {}'.format(chunk[0]['datetime'].strftime('%Y/%m/%d %H:%M:%S'), chunk[-1]['datetime'].strftime('%H:%M:%S'))
-        else:
-            title = '{} - {}'.format(chunk[0]['datetime'].strftime('%Y/%m/%d %H:%M:%S'), chunk[-1]['datetime'].strftime('%Y/%m/%d %H:%M:%S'))
-        for item in chunk:
-            if item['ext'] == 'mp4':
-                if item['type'].endswith('F'):
-                    videos_f.append(item)
-                elif item['type'].endswith('R'):
-                    videos_r.append(item)
-                else:
-                    pass
-
-        result = process_videos(options, time_start, time_end, 'F', videos_f, '{} Front'.format(title))
-        if not result:
-            break
-        result = process_videos(options, time_start, time_end, 'R', videos_r, '{} Rear'.format(title))
-        if not result:
-            break
+    if options.chunk_workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            _process_one_chunk(options, chunk)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.chunk_workers) as executor:
+        futures = [executor.submit(_process_one_chunk, options, chunk) for chunk in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('error: %s', e)
+
+def _process_one_chunk(options, chunk):
+    time_start = chunk[0].dt.strftime('%Y%m%d_%H%M%S')
+    time_end = chunk[-1].dt.strftime('%Y%m%d_%H%M%S')
+    logger.debug('%s-%s', time_start, time_end)
+    if not options.overwrite:
+        # Both outputs already on disk is the common case on re-runs; skip
+        # the chunk before walking it at all.
+        if all(os.path.exists(os.path.join(options.output_dir, '{}-{}_{}.mp4'.format(time_start, time_end, camera))) for camera in ('F', 'R')):
+            logger.debug('%s-%s, skipped (outputs already exist)', time_start, time_end)
+            return
+    if chunk[0].dt.date() == chunk[-1].dt.date():
+        title = '{} - {}'.format(chunk[0].dt.strftime('%Y/%m/%d %H:%M:%S'), chunk[-1].dt.strftime('%H:%M:%S'))
+    else:
+        title = '{} - {}'.format(chunk[0].dt.strftime('%Y/%m/%d %H:%M:%S'), chunk[-1].dt.strftime('%Y/%m/%d %H:%M:%S'))
+    buckets = {'F': [], 'R': []}
+    sink = []
+    for item in chunk:
+        if item.ext == 'mp4':
+            buckets.get(item.type[-1:], sink).append(item)
+
+    result = process_videos(options, time_start, time_end, 'F', buckets['F'], '{} Front'.format(title))
+    if not result:
+        return
+    result = process_videos(options, time_start, time_end, 'R', buckets['R'], '{} Rear'.format(title))
+    if not result:
+        return
 
 def process_videos(options, time_start, time_end, camera, videos, title):
     concat_filename = '{}-{}_{}.con'.format(time_start, time_end, camera)
@@ -152,148 +240,293 @@ def process_videos(options, time_start, time_end, camera, videos, title):
     playlist_filename = '{}-{}_{}.ply'.format(time_start, time_end, camera)
 
     if len(videos) <= options.concat_threshold:
-        logger.info('{}, skipped (less than concat_threshold={})'.format(title, options.concat_threshold))
+        logger.info('%s, skipped (less than concat_threshold=%s)', title, options.concat_threshold)
         return True
 
-    create_concat_file(options.work_dir, concat_filename, videos, options.no_output, options.overwrite)
+    # The chunk-level gate only fires when both cameras are done; this
+    # per-camera check keeps asymmetric chunks (one camera absent or below
+    # threshold) from re-probing their finished side on every run.
+    if not options.overwrite and os.path.exists(os.path.join(options.output_dir, output_filename)):
+        logger.info('%s, skipped (already exists)', output_filename)
+        return True
 
-    create_output_file(options.work_dir, concat_filename, options.output_dir, output_filename, options.no_output, options.overwrite)
+    # A per-output lock instead of the global one lets overlapping cron
+    # invocations work on different chunks concurrently. Lock files live in
+    # the work dir so the recordings dir stays clean.
+    lock = FileLock('{}.lock'.format(os.path.join(options.work_dir, output_filename)))
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        logger.info('%s, skipped (locked by another worker)', output_filename)
+        return True
+    try:
+        concat_text = create_concat_file(options, concat_filename, videos)
 
-    return True
+        if concat_text:
+            create_output_file(options, concat_text, output_filename)
+    finally:
+        lock.release()
 
-def create_concat_file(path, filename, videos, no_output, overwrite):
-    if os.path.exists(os.path.join(path, filename)):
-        if not overwrite:
-            logger.info('{}, skipped (already exists)'.format(filename))
-            return
+    return True
 
-    records = []
-    md5_last_frame = None
-    for video in videos:
-        cmd = ['ffmpeg',
+async def _probe_video(video, ffmpeg_threads, semaphore):
+    path = video.path
+    cmd = [_ffmpeg_bin(),
+           '-threads', str(ffmpeg_threads),
+           '-nostats',
+           '-hide_banner',
+           '-i', path,
+           '-an',
+           '-f', 'framemd5',
+           '-c', 'copy',
+           '-']
+    async with semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **_SPAWN_KWARGS)
+        except Exception as e:
+            logger.error('%s %s %s %s', video.dt, video.type, video.ext, e)
+            return path, None, {}, None
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        # Stream stdout instead of buffering ~1 md5 line per frame; keep only
+        # the last pts_time seen for each md5 plus the final frame's md5,
+        # which is all the chaining fold needs.
+        md5_pts = {}
+        md5_last = None
+        tb_num, tb_den = 1, 1
+        async for line in proc.stdout:
+            if line[:3] == b'#tb':
+                tb_num, tb_den = list(map(int, line.split()[-1].split(b'/')))
+            elif line[:1] != b'#' and len(line) > 1:
+                splitted = line.split(b',')
+                md5, pts_time = splitted[-1].strip().decode(), float(splitted[2]) * tb_num / tb_den
+                md5_pts[md5] = pts_time
+                md5_last = md5
+        returncode = await proc.wait()
+        stderr = await stderr_task
+        if returncode != 0:
+            logger.error(stderr.decode(errors='replace'))
+        return path, returncode, md5_pts, md5_last
+
+async def _probe_videos(videos, workers, ffmpeg_threads):
+    semaphore = asyncio.Semaphore(workers)
+    return await asyncio.gather(*[_probe_video(video, ffmpeg_threads, semaphore) for video in videos])
+
+def _fold_framemd5_lines(lines):
+    md5_pts = {}
+    md5_last = None
+    tb_num, tb_den = 1, 1
+    for line in lines:
+        if line[:3] == '#tb':
+            tb_num, tb_den = list(map(int, line.split()[-1].split('/')))
+        elif line[:1] != '#' and len(line) > 1:
+            splitted = line.split(',')
+            md5, pts_time = splitted[-1].strip(), float(splitted[2]) * tb_num / tb_den
+            md5_pts[md5] = pts_time
+            md5_last = md5
+    return md5_pts, md5_last
+
+def _batch_probe_videos(videos, work_dir, ffmpeg_threads):
+    # One ffmpeg invocation with one input and one framemd5 output per clip:
+    # process startup and libav init are paid once instead of per file. A
+    # single concat-demuxer pass would be cheaper still but rewrites pts
+    # continuously, so per-file boundaries could not be recovered.
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmpdir:
+        cmd = [_ffmpeg_bin(),
+               '-threads', str(ffmpeg_threads),
                '-nostats',
                '-hide_banner',
-               '-i', os.path.join(video['dir'], video['filename']),
-               '-an',
-               '-f', 'framemd5',
-               '-c', 'copy',
-               '-']
+               '-y']
+        for video in videos:
+            cmd += ['-i', video.path]
+        out_paths = []
+        for i in range(len(videos)):
+            out_path = os.path.join(tmpdir, '{}.framemd5'.format(i))
+            out_paths.append(out_path)
+            cmd += ['-map', '{}:v:0'.format(i), '-an', '-c', 'copy', '-f', 'framemd5', out_path]
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            result = subprocess.run(cmd, capture_output=True, text=True, **_SPAWN_KWARGS)
         except Exception as e:
-            logger.error('{} {} {} {} {}'.format(video['datetime'], video['type'], video['ext'], result.returncode, e))
-            logger.error(result.stdout)
+            logger.error('batch probe error: %s', e)
+            return None
+        if result.returncode != 0:
             logger.error(result.stderr)
+            return None
+        results = []
+        for video, out_path in zip(videos, out_paths):
+            with open(out_path) as f:
+                md5_pts, md5_last = _fold_framemd5_lines(f)
+            results.append((video.path, result.returncode, md5_pts, md5_last))
+        return results
+
+def create_concat_file(options, filename, videos):
+    path = options.work_dir
+    if os.path.exists(os.path.join(path, filename)):
+        if not options.overwrite:
+            logger.info('%s, reused (already exists)', filename)
+            with open(os.path.join(path, filename)) as f:
+                return f.read()
+
+    if options.fast_concat:
+        # Skip the probe pass entirely; every input is read once and the
+        # concatdec_select filter in create_output_file rejects overlap.
+        records = [(video.path, 0) for video in videos]
+        return _finish_concat_text(options, filename, records)
+
+    # The thread budget divides the cores among every ffmpeg running at
+    # once, which with chunk-level parallelism means chunk workers times
+    # the probes (or the one batch/concat process) within each chunk.
+    chunk_workers = max(1, options.chunk_workers)
+    ffmpeg_threads = options.ffmpeg_threads_per_invocation
+    results = None
+    if options.batch_probe:
+        results = _batch_probe_videos(videos, path, _clamp_ffmpeg_threads(ffmpeg_threads or _threads_per_invocation(chunk_workers)))
+    if results is None:
+        workers = max(1, min(options.probe_workers, len(videos)))
+        if ffmpeg_threads is None:
+            ffmpeg_threads = _threads_per_invocation(workers * chunk_workers)
+        results = asyncio.run(_probe_videos(videos, workers, _clamp_ffmpeg_threads(ffmpeg_threads)))
+
+    records = []
+    md5_last_frame = None
+    for video, (video_path, returncode, md5_pts, md5_last) in zip(videos, results):
+        if returncode is None:
             continue
-        inpoint, tb_num, tb_den = 0, 1, 1
-        for line in result.stdout.split('\n'):
-            if line.startswith('#tb'):
-                tb_num, tb_den = list(map(int, line.split()[-1].split('/')))
-            elif not line.startswith('#') and len(line) > 0:
-                splitted = line.split(',')
-                md5, pts_time = splitted[-1].strip(), float(splitted[2]) * tb_num / tb_den
-                if md5 == md5_last_frame:
-                    inpoint = pts_time
-        md5_last_frame = md5
-        if result.returncode != 0:
-            logger.warning('{} {} {} {} {}'.format(video['datetime'], video['type'], video['ext'], result.returncode, inpoint))
+        inpoint = md5_pts.get(md5_last_frame, 0)
+        if md5_last is not None:
+            md5_last_frame = md5_last
+        if returncode != 0:
+            logger.warning('%s %s %s %s %s', video.dt, video.type, video.ext, returncode, inpoint)
         else:
-            logger.debug('{} {} {} {} {}'.format(video['datetime'], video['type'], video['ext'], result.returncode, inpoint))
-        records.append((os.path.join(video['dir'], video['filename']), inpoint))
-
-    if no_output:
-        logger.info('{}, not created'.format(filename))
-        return
-
-    with open(os.path.join(path, filename), 'w') as f:
-        for record in records:
-            f.write("file '{}'\ninpoint {}\n".format(record[0], record[1]))
-
-    logger.info('{}, created'.format(filename))
+            logger.debug('%s %s %s %s %s', video.dt, video.type, video.ext, returncode, inpoint)
+        records.append((video_path, inpoint))
+
+    return _finish_concat_text(options, filename, records)
+
+def _finish_concat_text(options, filename, records):
+    # The concat list is handed to ffmpeg over stdin; it only touches disk
+    # when --keep-concat is set.
+    payload = _render_concat_text(records)
+    if options.keep_concat:
+        if options.no_output:
+            logger.info('%s, not created', filename)
+        else:
+            with open(os.path.join(options.work_dir, filename), 'w') as f:
+                f.write(payload)
+            logger.info('%s, created', filename)
+    return payload
 
-    return True
+def _render_concat_text(records):
+    # Single quotes in paths need the concat demuxer's '\'' escape.
+    return ''.join("file '{}'\ninpoint {}\n".format(p.replace("'", "'\\''"), inpoint) for p, inpoint in records)
 
-def create_output_file(path_work, concat_filename, path_output, output_filename, no_output, overwrite):
+def create_output_file(options, concat_text, output_filename):
 
-    if os.path.exists(os.path.join(path_output, output_filename)):
-        if not overwrite:
-            logger.info('{}, concat skipped (already exists)'.format(output_filename))
+    if os.path.exists(os.path.join(options.output_dir, output_filename)):
+        if not options.overwrite:
+            logger.info('%s, concat skipped (already exists)', output_filename)
             return True
 
-    if no_output:
-        logger.info('{}, not created'.format(output_filename))
+    if options.no_output:
+        logger.info('%s, not created', output_filename)
         return
 
-    cmd = ['ffmpeg',
+    # One concat runs per chunk worker at a time, so the cores are split
+    # between them rather than handing every concat the whole machine.
+    ffmpeg_threads = _clamp_ffmpeg_threads(options.ffmpeg_threads_per_invocation or _threads_per_invocation(max(1, options.chunk_workers)))
+
+    cmd = [_ffmpeg_bin(),
+           '-threads', str(ffmpeg_threads),
            '-fflags',
            '+genpts+igndts',
            '-f', 'concat',
            '-safe', '0',
            '-segment_time_metadata', '1',
-           '-i', os.path.join(path_work, concat_filename),
+           '-protocol_whitelist', 'file,pipe',
+           '-i', '-',
            '-c:v', 'copy',
            '-af', 'aselect=concatdec_select,aresample=async=1',
-           '-y', os.path.join(path_output, output_filename)]
+           '-y', os.path.join(options.output_dir, output_filename)]
 
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = subprocess.run(cmd, capture_output=True, text=True, input=concat_text, **_SPAWN_KWARGS)
     except Exception as e:
-        logger.error('error: {}'.format(e))
-        logger.error('stdout: {}'.format(result.stdout))
-        logger.error('stderr: {}'.format(result.stderr))
+        logger.error('error: %s', e)
+        return False
 
     if result.returncode != 0:
-        logger.warning('{}, ended, returncode {}'.format(output_filename, result.returncode))
+        logger.warning('%s, ended, returncode %s', output_filename, result.returncode)
         return False
 
-    logger.info('{}, created, returncode {}'.format(output_filename, result.returncode))
+    logger.info('%s, created, returncode %s', output_filename, result.returncode)
 
     return True
 
 def cleanup(options):
     today_obj = datetime.date.today()
-    cleanup_files(options.work_dir, PATTERN_WORKFILES, today_obj, options.retention)
-    cleanup_files(options.output_dir, PATTERN_OUTPUTFILES, today_obj, options.retention)
-
-def cleanup_files(directory, filepattern, today_obj, retention):
-    files = sorted(os.listdir(directory))
-    pattern = re.compile(filepattern)
-    for f in files:
-        if not os.path.isfile(os.path.join(directory, f)):
+    cleanup_files(options.work_dir, _RE_WORKFILES, today_obj, options.retention, lock_companion_dir=options.output_dir)
+    cleanup_files(options.output_dir, _RE_OUTPUTFILES, today_obj, options.retention)
+
+def cleanup_files(directory, pattern, today_obj, retention, lock_companion_dir=None):
+    with os.scandir(directory) as it:
+        entries = sorted((e for e in it if e.is_file(follow_symlinks=False)), key=lambda e: e.name)
+    cutoff = time.time() - retention * 86400
+    for entry in entries:
+        # One stat syscall per entry (cached on the DirEntry afterwards)
+        # buys skipping the regex match and date parse for everything
+        # still inside the retention window - the common case.
+        if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+            continue
+        if entry.name.endswith('.lock'):
+            # Old per-output lock whose companion output is gone: no live
+            # worker can hold it (a holder would be rebuilding that output,
+            # and a fresh lock is shielded by the mtime cutoff above).
+            companion = os.path.join(lock_companion_dir or directory, entry.name[:-len('.lock')])
+            if not os.path.exists(companion):
+                logger.info('Deleting %s', entry.path)
+                try:
+                    os.remove(entry.path)
+                except Exception as e:
+                    logger.error('error: %s', e)
             continue
-        matches = pattern.match(f)
+        matches = pattern.match(entry.name)
         if not matches:
             continue
-        datetime_obj = datetime.datetime.strptime(matches.group(1), '%Y%m%d_%H%M%S')
+        datetime_obj = _dt_from_match(matches)
         date_obj = datetime_obj.date()
         if today_obj - date_obj <= datetime.timedelta(days=retention):
             continue
-        logger.info('Deleting {}'.format(os.path.join(directory, f)))
+        logger.info('Deleting %s', entry.path)
         try:
-            os.remove(os.path.join(directory, f))
+            os.remove(entry.path)
         except Exception as e:
-            logger.error('error: {}'.format(e))
+            logger.error('error: %s', e)
 
 def run(options):
 
     logger.debug('start')
 
     if not os.path.exists(options.source_dir):
-        logger.error('source_dir {} not exists'.format(options.source_dir))
+        logger.error('source_dir %s not exists', options.source_dir)
         sys.exit()
 
     if not os.path.exists(options.work_dir):
-        logger.error('work_dir {} not exists'.format(options.work_dir))
+        logger.error('work_dir %s not exists', options.work_dir)
         sys.exit()
 
     if not os.path.exists(options.output_dir):
-        logger.error('output_dir {} not exists'.format(options.output_dir))
+        logger.error('output_dir %s not exists', options.output_dir)
         sys.exit()
 
-    chunks = create_chunks(options)
+    # The global lock now guards only the scan and cleanup phases; chunk
+    # processing is serialized per output file in process_videos so
+    # overlapping runs can share the work.
+    lock = FileLock('{}.lock'.format(__file__))
+    with lock:
+        chunks = create_chunks(options)
     result = process_chunks(options, chunks)
-    cleanup(options)
-    
+    with lock:
+        cleanup(options)
+
 if __name__ == "__main__":
 
     options = get_options()
@@ -302,6 +535,4 @@ if __name__ == "__main__":
         sys.exit()
     set_logging_level(options)
 
-    lock = FileLock('{}.lock'.format(__file__))
-    with lock:
-        run(options)
+    run(options)